@@ -2,9 +2,15 @@ import sqlite3
 import pprint
 import copy
 import os
-from shutil import copyfile
+import errno
+import functools
+import itertools
+import shutil
 import argparse
 import sys
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 ##Intended for python3.6 on linux, probably won't work on Windows
 ##This software is distributed without any warranty. It will probably brick your computer.
@@ -17,6 +23,8 @@ def print_help():
     print("  --db          Path to the file DB (example: /restsdk/data/db/index.db)")
     print("  --filedir     Path to the files directory (example: /restsdk/data/files)")
     print("  --dumpdir     Path to the directory to dump files (example: /location/to/dump/files/to)")
+    print("  --threads     Number of files to copy in parallel (default: 16)")
+    print("  --verbose     Print every file as it is found and copied")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -24,6 +32,8 @@ if __name__ == "__main__":
     parser.add_argument('--db', type=str, help='Path to the file DB')
     parser.add_argument('--filedir', type=str, help='Path to the files directory')
     parser.add_argument('--dumpdir', type=str, help='Path to the directory to dump files')
+    parser.add_argument('--threads', type=int, default=16, help='Number of files to copy in parallel')
+    parser.add_argument('--verbose', action='store_true', default=False, help='Print every file as it is found and copied')
     args = parser.parse_args()
     
     print(args.db)  # Outputs: /path/to/my/file.txt
@@ -34,6 +44,8 @@ if __name__ == "__main__":
     filedir = args.filedir
     dumpdir = args.dumpdir
     dry_run = args.dry_run
+    threads = max(1, args.threads)
+    verbose = args.verbose
     
     if db is None or filedir is None or dumpdir is None:
         print("Error: Missing required arguments. Please provide values for --db, --filedir, and --dumpdir.")
@@ -49,109 +61,227 @@ if __name__ == "__main__":
         sys.exit(0)
 skipnames=[filedir] #remove these strings from the final file/path name. Don't edit this.
 
-def findNextParent(fileID):
-    #finds the next parent db item in a chain
-    for key,value in fileDIC.items():
-        if key==fileID:
-            return value['Parent']
-def hasAnotherParent(fileID):
-    #checks to see if a db item has another parent
-    if fileDIC[fileID]['Parent']!=None:
-        return True
-    else:
-        return False
-def findTree(fileID,name,parent):
-    #turn a file ID into an original path
-    path=fileDIC[parent]['Name']+"/"+name
-    while hasAnotherParent(fileID)==True:
-        fileID=findNextParent(fileID)
-        path=fileDIC[fileID]['Name']+'/'+path
-    return path
+@functools.lru_cache(maxsize=None)
+def dirToPath(dirID):
+    #turn a directory ID into its original path, cached so each folder is assembled once however many files it holds
+    parent=fileParents[dirID]
+    if parent is None:
+        return fileNames[dirID]
+    return dirToPath(parent)+'/'+fileNames[dirID]
 
 def idToPath2(fileID):
     #turn a file ID into an original path
-    value=fileDIC[fileID]
-    if value['Parent']!=None:
-        #print("Found file " + value['Name'] + 'searching for parents')
-        #print('Totalpath is ' + path)
-        path=findTree(fileID,value['Name'],value['Parent'])
+    parent=fileParents[fileID]
+    if parent is not None:
+        path=dirToPath(parent)+'/'+fileNames[fileID]
     else:
-        #print("Found file " + value['Name'] + 'no parent search needed')
-        path=fileDIC[fileID]['Name']
+        path=fileNames[fileID]
     return path
 
 def filenameToID(filename):
     #turn a filename from filesystem into a db id
-    for keys,values in fileDIC.items():
-        if values['contentID']==filename:
-            #print('Found filename ' + filename + ' in DBkey ' + str(keys) +' with name ' + values['Name'])
-            return str(keys)
-    #print('Unable to find filename' + filename)
-    return None
+    return contentIDtoID.get(filename)
+
+#errors meaning "this kernel/filesystem can't do that copy", so the next method is tried
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSOCK)
+COPY_BUFSIZE = 1 << 18 #256 KiB per read/write in the fallback copy, shutil's 64 KiB default is small for disk-to-disk
+
+def copyContents(fsrc, fdst):
+    #copy file contents inside the kernel where possible: copy_file_range, then sendfile, then a plain read/write loop
+    infd = fsrc.fileno()
+    outfd = fdst.fileno()
+    size = os.fstat(infd).st_size
+    copied = 0
+    done = False
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while True:
+                sent = os.copy_file_range(infd, outfd, 1 << 30)
+                if not sent:
+                    #some filesystem/kernel combinations return 0 without copying anything, so like coreutils
+                    #only take 0 as EOF once bytes have moved (or the file really is empty)
+                    done = copied > 0 or size == 0
+                    break
+                copied += sent
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+    if not done and hasattr(os, 'sendfile'):
+        try:
+            while True:
+                sent = os.sendfile(outfd, infd, None, 1 << 30)
+                if not sent:
+                    done = copied > 0 or size == 0
+                    break
+                copied += sent
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+    if not done:
+        #both fds have advanced past whatever the kernel already copied, so this picks up where it stopped
+        shutil.copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+        fdst.flush()
+    written = os.fstat(outfd).st_size
+    if written != size:
+        raise OSError(errno.EIO, 'short copy, wrote ' + str(written) + ' of ' + str(size) + ' bytes')
+
+def fastCopy(src, dst):
+    #copy src to dst with a sequential read-ahead hint, then drop the source pages from the page cache since each file is only read once
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        copyContents(fsrc, fdst)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def scanTree(top):
+    #yield a DirEntry for every regular file under top, using the file types readdir already returned instead of stat'ing
+    pending=[top]
+    while pending:
+        dirpath=pending.pop()
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file():
+                        #regular files (or links to them) only: opening a FIFO would block a copy worker forever,
+                        #and os.walk never descended into or yielded directory symlinks either
+                        yield entry
+        except OSError as e:
+            #unreadable directory (EACCES/EIO on a failing disk): warn and carry on like os.walk does
+            print('Warning: unable to read directory ' + dirpath + ': ' + str(e))
+
+def copyFile(fullpath, newpath):
+    #copy one already-resolved file into dumpdir, runs on the copy pool
+    global processed_files
+    try:
+        if verbose:
+            print('Copying ' + newpath)
+        try:
+            newdir = os.path.dirname(newpath)
+            if newdir not in madeDirs:
+                os.makedirs(newdir, exist_ok=True)
+                madeDirs.add(newdir)
+            fastCopy(fullpath, newpath)
+        except:
+            print('Error copying file ' + fullpath + ' to ' + newpath)
+            return
+        processed_files = next(copiedCount) #count.__next__ is atomic under the GIL, this only feeds the status line
+    finally:
+        copySlots.release()
+
+def dryRunFile(fullpath, newpath):
+    #report what would be copied without touching dumpdir
+    print('Dry run: Skipping copying ' + fullpath + ' to ' + newpath)
+
+def queueCopy(fullpath, newpath):
+    #hand a resolved file to the copy pool, blocking while enough copies are already queued
+    earlier = inFlight.get(newpath)
+    if earlier is not None:
+        #another db row resolved to the same destination: let that copy finish first so the two never truncate
+        #each other mid-write, and the last one wins the way it did when copies ran one after another
+        earlier.result()
+    if len(inFlight) >= inFlightPruneAt:
+        for path in [path for path, future in inFlight.items() if future.done()]:
+            del inFlight[path]
+    copySlots.acquire()
+    inFlight[newpath] = copyPool.submit(copyFile, fullpath, newpath)
+
+def printProgress(done):
+    #rewrite one status line a second until done is set, instead of printing from every copy
+    while not done.wait(1):
+        print(f'Progress: {processed_files} of {total_files} files ({processed_files / total_files * 100:.2f}%)', end="\r")
+    print(f'Progress: {processed_files} of {total_files} files ({processed_files / total_files * 100:.2f}%)')
 
 def getRootDirs():
     #quick function to find annoying "auth folder" name for filtering purposes
-    for keys,values in fileDIC.items():
-        if 'auth' in values['Name'] and '|' in values['Name']:
-            return str(values['Name'])
+    for name in fileNames.values():
+        if 'auth' in name and '|' in name:
+            return str(name)
 
 #open the sqlite database
-print('Opening database...',end="/r")
+print('Opening database...',end="\r")
+#read-only: never create an empty db for a mistyped path, and never take write locks on the recovered one
+dbURI = pathlib.Path(db).resolve().as_uri()
+if os.path.exists(db + '-journal'):
+    #a hot rollback journal means the device died mid-write, SQLite has to roll it back before the db can be read at all
+    #mode=rw still refuses to create a missing file; immutable would skip the check and read the uncommitted pages as valid
+    print('Found ' + db + '-journal, opening read-write so SQLite can roll back the unfinished transaction')
+    dbURI += '?mode=rw'
+elif os.path.exists(db + '-wal'):
+    #a leftover WAL may still hold committed rows, immutable would make SQLite ignore them
+    dbURI += '?mode=ro'
+else:
+    #nothing else writes an extracted db, so skip locking and sidecar files
+    dbURI += '?mode=ro&immutable=1'
 try:
-    con = sqlite3.connect(db)
-except:
-    print('Error opening database at ' + db)
+    con = sqlite3.connect(dbURI, uri=True)
+    #read-side tuning only; no mmap_size, since on a failing drive a bad page read would arrive as SIGBUS and kill the run silently
+    con.execute('PRAGMA cache_size=-65536')
+    print('Querying database...',end="\r")
+    cur = con.cursor()
+    cur.arraysize = 10000 #rows pulled per fetchmany, keeps memory flat on big DBs
+    cur.execute("SELECT id,name,parentID,contentID FROM files")
+except (sqlite3.Error, OSError) as e:
+    #connect alone may not touch the file, so the first statements are where a bad or unreadable db shows up
+    print('Error opening database at ' + db + ': ' + str(e))
     quit()
-print('Querying database...',end="/r")
-cur = con.cursor()
-cur.execute("SELECT id,name,parentID,mimeType,contentID FROM files")
-files = cur.fetchall()
 #SQlite has a table named "FILES", the filename in the file structure is found in ContentID, with the parent directory being called ParentID
-fileDIC={}
+#one flat dict per column instead of a small dict per row, a few hundred bytes less per file on multi-million row DBs
+fileNames={}
+fileParents={}
+contentIDtoID={} #reverse index so a filename on disk resolves to a db id without scanning the table
 
-for file in files:
-    fileID=file[0]
-    fileName=file[1]
-    fileParent=file[2]
-    mimeType=file[3]
-    contentID=file[4]
-    fileDIC[fileID]={'Name':fileName,'Parent':fileParent,'contentID':contentID,'Type':mimeType,'fileContentID':''}
+rows = cur.fetchmany()
+while rows:
+    for fileID,fileName,fileParent,contentID in rows:
+        fileNames[fileID]=fileName
+        fileParents[fileID]=fileParent
+        if contentID is not None:
+            contentIDtoID.setdefault(contentID, fileID) #first row wins on a repeated contentID, as the old linear scan did
+    rows = cur.fetchmany()
+con.close() #everything after this point works from the in-memory columns
 
 skipnames.append(getRootDirs()) #remove obnoxious root dir names
+skipPrefixes = tuple(name for name in skipnames if name) #getRootDirs returns None when there is no auth folder
 
-total_files = sum([len(files) for _, _, files in os.walk(filedir)])  # total number of files to be processed
+total_files = len(contentIDtoID)  # every db row with a contentID is a file we expect to find on disk
 processed_files = 0  # counter for processed files
+copiedCount = itertools.count(1)
+madeDirs = set()  # destination directories already created, so makedirs runs once per directory
+copySlots = threading.BoundedSemaphore(threads * 4)  # keeps enough copies queued to saturate the pool without buffering the whole tree
+copyPool = ThreadPoolExecutor(max_workers=threads)
+inFlight = {}  # destination path -> future of its latest copy, only touched by the walker thread
+inFlightPruneAt = threads * 4 * 8  # copySlots bounds the unfinished ones, so dropping finished entries here keeps this small
+copyDone = threading.Event()
+progressThread = threading.Thread(target=printProgress, args=(copyDone,), daemon=True)
+
+handleFile = dryRunFile if dry_run else queueCopy  # picked once so the walk loop doesn't re-test dry_run per file
+
+print('Total files to copy ' + str(total_files))
+if not dry_run and total_files:
+    progressThread.start()
+
+for entry in scanTree(filedir):  # find all files in original directory structure
+    filename = entry.name
+    if verbose:
+        print('FOUND FILE ' + filename + ' SEARCHING......')
+    fileID = filenameToID(filename)
+    if fileID is None:
+        continue  # not in the db, nothing to name it after
+    newpath = idToPath2(fileID)
+    for prefix in skipPrefixes:
+        if newpath.startswith(prefix):
+            newpath = newpath[len(prefix):]
+            break
+    handleFile(entry.path, dumpdir + newpath)
 
-print('Total files to copy ' + total_files)
-
-for root, dirs, files in os.walk(filedir):  # find all files in original directory structure
-    for file in files:
-        filename = str(file)
-        print('FOUND FILE ' + filename + ' SEARCHING......', end="\r")
-        print('Processing ' + processed_files + ' of ' + total_files + ' files', end="\r")
-        fileID = filenameToID(str(file))
-        fullpath = None
-        if fileID != None:
-            fullpath = idToPath2(fileID)
-        if fullpath != None:
-            # print('FILE RESOLVED TO ' + fullpath)
-            for paths in skipnames:
-                newpath = fullpath.replace(paths, '')
-            newpath = dumpdir + newpath
-            fullpath = str(os.path.join(root, file))
-            if dry_run:
-                print('Dry run: Skipping copying ' + fullpath + ' to ' + newpath)
-            else:
-                # print('Copying ' + fullpath + ' to ' + newpath,end="\r")
-                print('Copying ' + newpath)
-                try:
-                    os.makedirs(os.path.dirname(newpath), exist_ok=True)
-                    copyfile(fullpath, newpath)
-                    processed_files += 1
-                    progress = (processed_files / total_files) * 100
-                    print(f'Progress: {progress:.2f}%')
-                except:
-                    print('Error copying file ' + fullpath + ' to ' + newpath)
+copyPool.shutdown(wait=True)
+processed_files = next(copiedCount) - 1 #workers can store their count out of order, take the exact total once they are done
+if progressThread.is_alive():
+    copyDone.set()
+    progressThread.join()
 
 print("Did this script help you recover your data? Save you a few hundred bucks? Or make you some money recovering somebody else's data?")
 print("Consider sending us some bitcoin/crypto as a way of saying thanks!")